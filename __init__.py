@@ -5,4 +5,4 @@ Created on Mon Dec 20 17:20:32 2021
 @author: marcu
 """
 
-from .sqlite_database import TableCon, MultiConnection
\ No newline at end of file
+from .sqlite_database import TableCon, MultiConnection, TableConPool
\ No newline at end of file
@@ -5,25 +5,96 @@ Created on Tue Sep 14 22:29:57 2021
 @author: marcu
 """
 
+import functools
+import itertools
+import logging
+import operator
+import queue
 import sqlite3 as sql
+import threading
+import types
 import warnings
+from contextlib import contextmanager
 from datetime import datetime
+from pathlib import Path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
 
 class TableCon:
-    def __init__(self, db, table = None, debug = False, isolation_level = None,
-                 **kwargs):
+    def __init__(self, db, table = None, debug = False,
+                 isolation_level = "DEFERRED",
+                 journal_mode = "WAL", synchronous = "NORMAL",
+                 cache_kib = 65536, con = None, row_factory = sql.Row,
+                 pool_size = 4, pool = None, **kwargs):
         """
-        isolation_level = None causes the database to operate in autocommit
-        mode. This means transactions are committed as soon as they are
-        issued, removing "database is locked" errors.
+        debug = True logs each query this instance executes at DEBUG level to
+        this module's logger. The flag only affects this instance; configure
+        logging, e.g. logging.basicConfig(level = logging.DEBUG), to see the
+        queries.
+
+        journal_mode, synchronous and cache_kib set the corresponding PRAGMAs
+        each time a database is connected to. WAL journalling allows readers
+        and a writer to work concurrently and, with synchronous = "NORMAL",
+        syncs to disk only at checkpoints rather than on every commit.
+        cache_kib is the page cache size in KiB. Pass None to leave a PRAGMA
+        at the database default.
+
+        With the default isolation_level = "DEFERRED", data-modifying
+        statements run through execute or update open a transaction that is
+        only committed by commit() or close(), or by leaving a transaction()
+        they were run inside.
+        insert and insert_many commit their own rows unless called inside an
+        open transaction. Use transaction() to group multiple statements into
+        one commit.
+
+        row_factory is set on the cursor, so rows returned by queries are
+        sqlite3.Row objects by default, indexable by position or column name.
+        Pass row_factory = None to return plain tuples.
+
+        con is an optional existing connection to db to share, for example
+        between several tables. A shared connection is left open by close().
+
+        pool_size is the number of connections in the read-only pool used by
+        filter and select with readonly = True, which are opened on first
+        use. To share one pool between instances, pass an existing
+        TableConPool as pool or assign it to the pool attribute. A shared
+        pool is left open by close().
         """
         self._connection_kwargs = kwargs
         self._connection_kwargs["isolation_level"] = isolation_level
+        self._connection_kwargs.setdefault("cached_statements", 1024)
+        self._pragmas = {"journal_mode": journal_mode,
+                         "synchronous": synchronous,
+                         "temp_store": "MEMORY",
+                         "cache_size": (None if cache_kib is None
+                                        else -1 * cache_kib)}
         self.con = None
-        self.set_db(db)
+        self._shared_con = False
+        self._columns_cache = {}
+        self._insert_stmt_cache = {}
+        self._row_factory = row_factory
+        self._pool_size = pool_size
+        self._pool = None
+        self._shared_pool = False
+        self.set_db(db, con)
+        if pool is not None:
+            self.pool = pool
         self.table = table
         self.debug = debug
-        self.field_map = {}
+        # mapped names are cached per sequence of field names
+        self._map_keys = functools.lru_cache(maxsize = 256)(
+            lambda keys: tuple(self._field_map.get(k, k) for k in keys))
+        self.define_field_map({})
 
     def open(self, db = None, table = None):
         """
@@ -32,7 +103,7 @@ class TableCon:
         db : str : Path to the database file
         table : str : name of the table
         """
-        if not self.con is None:
+        if self.con is not None:
             self.close()
 
         if db is None: db = self.db
@@ -42,35 +113,117 @@ class TableCon:
         self.set_table(table)
 
     def close(self):
-        """ Close the database connection """
-        if not self.con is None:
-            self.con.close()
+        """ Commit any outstanding transaction and close the database
+        connection, or only the cursor if the connection is shared """
+        if self._pool is not None:
+            if not self._shared_pool:
+                self._pool.close()
+            self._pool = None
+        if self.con is not None:
+            if self._shared_con:
+                self.cur.close()
+            else:
+                self.con.commit()
+                self.con.close()
             self.con = None
             self.cur = None
 
     def commit(self):
         """ Commit all database transactions """
-        if not self.con is None:
+        if self.con is not None:
             self.con.commit()
 
-    def set_db(self, db):
-        """ Open connection to the database """
+    @property
+    def pool(self):
+        """ Read-only connection pool used by queries with readonly = True """
+        return self._pool
+
+    @pool.setter
+    def pool(self, pool):
+        if self._pool is not None and not self._shared_pool:
+            self._pool.close()
+        self._pool = pool
+        self._shared_pool = pool is not None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group all statements executed inside the context into a single
+        transaction, committed on exit or rolled back if an exception is
+        raised.
+
+        If a transaction is already open on the connection, whether from an
+        enclosing transaction(), another table sharing the connection, or
+        uncommitted statements run through execute, the context joins it
+        through a savepoint instead. On an exception only the statements
+        inside the context are rolled back, and committing is left to
+        whoever opened the outer transaction.
+
+        with tcon.transaction():
+            for row in rows:
+                tcon.insert(**row)
+        """
+        if self.con.in_transaction:
+            self.cur.execute("SAVEPOINT tablecon_transaction")
+            try:
+                yield
+            except:
+                self.cur.execute("ROLLBACK TO tablecon_transaction")
+                self.cur.execute("RELEASE tablecon_transaction")
+                raise
+            self.cur.execute("RELEASE tablecon_transaction")
+            return
+
+        self.cur.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self.con.rollback()
+            raise
+        self.con.commit()
+
+    def set_db(self, db, con = None):
+        """ Open connection to the database, or use an existing connection to
+        it """
         self.close()
+        self.invalidate_schema_cache()
         self.db = db
-        self.con = sql.connect(db, **self._connection_kwargs)
+        self._shared_con = con is not None
+        if con is None:
+            con = sql.connect(db, **self._connection_kwargs)
+        self.con = con
         self.cur = self.con.cursor()
+        self._pool = TableConPool(db, size = self._pool_size)
+        self._shared_pool = False
+        self.cur.row_factory = self._row_factory
+        for pragma, value in self._pragmas.items():
+            if value is not None:
+                self.cur.execute("PRAGMA %s = %s" % (pragma, value))
 
     def set_table(self, table):
         """ Set the default table to query """
+        self.invalidate_schema_cache()
         self.table = table
 
+    def invalidate_schema_cache(self):
+        """ Clear cached column details. Call after altering the schema of a
+        table. """
+        self._columns_cache.clear()
+
     def get_columns(self):
         """ Return dictionary of column names and type details """
+        key = (self.db, self.table)
+        if key in self._columns_cache:
+            return self._columns_cache[key]
+
         cols = self.execute("PRAGMA table_info(%s)" % self.table,
                             select = True)
         col_dict = {x[1]: {'order': x[0], 'type': x[2],
                            'nullable': (x[3] == 1), 'default': x[4]}
                     for x in cols}
+        # a table with no columns doesn't exist yet, so don't cache it
+        if len(col_dict) > 0:
+            self._columns_cache[key] = col_dict
         return col_dict
 
     def get_datatypes(self):
@@ -82,225 +235,553 @@ class TableCon:
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
 
     def get_tables(self):
-        """ Return list of tables in connected database """
-        return self.execute("SELECT name FROM sqlite_master "
-                            "WHERE type='table'", select = True)
+        """ Return list of tables in connected database, as one-item tuples
+        regardless of row_factory """
+        return [tuple(row) for row in
+                self.execute("SELECT name FROM sqlite_master "
+                             "WHERE type='table'", select = True)]
+
+    @property
+    def field_map(self):
+        """ Read-only view of the map from field names used in write_values to
+        those in the specified table. Change the map by assigning a new
+        dictionary or calling define_field_map. """
+        return types.MappingProxyType(self._field_map)
+
+    @field_map.setter
+    def field_map(self, field_map):
+        # store a copy, so the cache of mapped names can't go stale through
+        # changes to the caller's dictionary
+        self._field_map = dict(field_map)
+        self._map_keys.cache_clear()
 
     def define_field_map(self, field_map):
         """ Define a map from field names used in write_values to those in the
-        specified table. Persistent across changes in table or database. """
+        specified table. Persistent across changes in table or database. The
+        map is copied, so later changes to field_map have no effect unless it
+        is defined again. """
         self.field_map = field_map
 
     def map_field_names(self, fields):
         """ Update a single field name or dict/list of field names based on
         the field_map """
         if isinstance(fields, dict):
-            mapped_dict = {}
-            for k, v in fields.items():
-                mapped_dict[self.field_map[k] if k in self.field_map
-                            else k] = v
-            return mapped_dict
+            return dict(zip(self._map_keys(tuple(fields)), fields.values()))
         elif isinstance(fields, list):
-            return [self.field_map[k] if k in self.field_map else k
-                    for k in fields]
+            return list(self._map_keys(tuple(fields)))
         elif isinstance(fields, str):
-            return (self.field_map[fields] if fields in self.field_map
-                    else fields)
+            return self._field_map.get(fields, fields)
 
     def insert(self, *args, **kwargs):
         """ Insert values into the table based on either column position or
-        field names """
+        field names. When inserting rows in a loop, wrap the loop in
+        `with tcon.transaction():` to commit them all at once. """
         if len(args) > 0 and len(kwargs) > 0:
             raise ValueError("Field map cannot be defined by both order and "
                              "name")
         if len(kwargs) > 0:
-            query = self._query_insert_kwargs(**kwargs)
+            self.insert_many([kwargs])
         else:
-            query = self._query_insert_args(*args)
-
-        self.execute(query, select = False)
-
-    def _query_insert_args(self, *args):
-        sql_val = "INSERT INTO %s VALUES(" % self.table
-        for v in args:
-            v = self._sanitise(v)
-            sql_val += self._quote(v) + ","
-
-        sql_val = sql_val[:-1]
+            self.insert_many([args])
 
-        query = sql_val + ")"
-        return query
-
-    def _query_insert_kwargs(self, **kwargs):
-        kwargs = self.map_field_names(kwargs)
-        sql_col = "INSERT INTO %s (" % self.table
-        sql_val = "VALUES ("
-        for k, v in kwargs.items():
-            v = self._sanitise(v)
-            sql_col += self._bracket(k) + ","
-            sql_val += self._quote(v) + ","
-
-        sql_col = sql_col[:-1]
-        sql_val = sql_val[:-1]
-
-        query = sql_col + ") " + sql_val + ")"
-        return query
+    def insert_many(self, rows, columns = None):
+        """
+        Insert multiple rows into the table in a single transaction using one
+        prepared statement.
+
+        rows is a list of either tuples of values in column order, or of
+        dictionaries of field names and values. columns is an optional list of
+        field names giving the order of the values in each tuple, or the keys
+        to take from each dictionary. If not given, tuples are inserted by
+        column position and dictionaries use the keys of the first row.
+        """
+        rows = list(rows)
+        if len(rows) == 0:
+            return
+
+        if isinstance(rows[0], dict) and columns is None:
+            columns = list(rows[0].keys())
+        if len(rows[0] if columns is None else columns) == 0:
+            raise ValueError("At least one value must be given for each row")
+
+        if isinstance(rows[0], dict):
+            getter = operator.itemgetter(*columns)
+            if len(columns) == 1:
+                rows = [(getter(row),) for row in rows]
+            else:
+                rows = [getter(row) for row in rows]
+
+        ncols = len(rows[0]) if columns is None else len(columns)
+        # rows are flattened into multi-row VALUES lists below, so a row of
+        # the wrong length would silently shift values into the next row
+        for row in rows:
+            if len(row) != ncols:
+                raise ValueError("Expected %s values in each row, got %s: %r"
+                                 % (ncols, len(row), row))
+
+        if columns is None:
+            query = "INSERT INTO %s VALUES " % self.table
+        else:
+            columns = self._map_keys(tuple(columns))
+            query = "INSERT INTO %s (%s) VALUES " % (
+                self.table, self._bracket_join(columns))
+
+        # pack as many rows into each statement as the host parameter limit
+        # allows
+        chunk = max(1, min(len(rows), self._max_variables() // ncols))
+        full_chunks = len(rows) // chunk
+        remainder = rows[full_chunks * chunk:]
+
+        query_chunk = query + self._placeholders(ncols, chunk)
+        params_chunk = (
+            list(itertools.chain.from_iterable(rows[i:i + chunk]))
+            for i in range(0, full_chunks * chunk, chunk))
+
+        if self.debug: logger.debug("%s", query_chunk)
+
+        # join a transaction already in progress rather than nesting
+        begin = not self.con.in_transaction
+        if begin: self.con.execute("BEGIN")
+        try:
+            self.cur.executemany(query_chunk, params_chunk)
+            if len(remainder) > 0:
+                self.cur.execute(
+                    query + self._placeholders(ncols, len(remainder)),
+                    list(itertools.chain.from_iterable(remainder)))
+        except:
+            if begin: self.con.execute("ROLLBACK")
+            raise
+        if begin: self.con.execute("COMMIT")
+
+    @staticmethod
+    @functools.lru_cache(maxsize = 128)
+    def _bracket_join(cols):
+        """ Return a tuple of column names as a comma-separated list of
+        bracketed identifiers """
+        return "[" + "], [".join(cols) + "]"
+
+    @staticmethod
+    @functools.lru_cache(maxsize = 128)
+    def _placeholders(ncols, nrows = 1):
+        """ Return the VALUES placeholders for nrows rows of ncols values """
+        row_values = "(%s)" % ",".join(["?"] * ncols)
+        return ",".join([row_values] * nrows)
+
+    def _max_variables(self):
+        """ Return the maximum number of host parameters allowed in a single
+        statement """
+        if hasattr(self.con, "getlimit"):
+            return self.con.getlimit(sql.SQLITE_LIMIT_VARIABLE_NUMBER)
+        # SQLITE_MAX_VARIABLE_NUMBER default prior to SQLite 3.32.0
+        return 999
 
     def add_row(self, **kwargs):
         """ Given either a dictionary of field names mapped to field values, or
-        field names as keywords with values field values, build the INSERT INTO
-        SQL string. """
+        field names as keywords with values field values, insert a row into
+        the table. When inserting rows in a loop, wrap the loop in
+        `with tcon.transaction():` to commit them all at once. """
         warnings.warn("deprecated", DeprecationWarning)
 
+        # the statement is built once per table and set of fields, so
+        # repeated calls only bind new values
         kwargs = self.map_field_names(kwargs)
-        sql_col = "INSERT INTO %s (" % self.table
-        sql_val = "VALUES ("
-        for k, v in kwargs.items():
-            v = self._sanitise(v)
-            sql_col += self._bracket(k) + ","
-            sql_val += self._quote(v) + ","
-
-        sql_col = sql_col[:-1]
-        sql_val = sql_val[:-1]
-
-        query = sql_col + ") " + sql_val + ")"
-        self.execute(query, select = False)
-
-    def _quote(self, string):
-        return "'%s'" % string
-
-    def _bracket(self, string):
-        return "[%s]" % string
-
-    def _sanitise(self, value):
-        if isinstance(value, str):
-            return value.replace("'", "''")
-        elif isinstance(value, list):
-            return [self._sanitise(v) for v in value]
-        else:
-            return value
-
-    def execute(self, query, select = False):
-        """ Execute a arbitrary SQL script. If the query returns rows, set
-        select = True. """
-        if self.debug: print(query)
-
-        cursor = self.cur.execute(query)
+        keys = tuple(sorted(kwargs))
+        query = self._insert_stmt_cache.get((self.table, keys))
+        if query is None:
+            query = "INSERT INTO %s (%s) VALUES %s" % (
+                self.table, self._bracket_join(keys),
+                self._placeholders(len(keys)))
+            self._insert_stmt_cache[(self.table, keys)] = query
+
+        # commit unless called inside an open transaction, as insert does,
+        # and don't leave the implicit transaction open if the insert fails
+        begin = not self.con.in_transaction
+        try:
+            self.execute(query, [kwargs[k] for k in keys])
+        except:
+            if begin: self.con.rollback()
+            raise
+        if begin: self.commit()
+
+    def execute(self, query, params = (), select = False):
+        """ Execute a arbitrary SQL script, binding params to any ?
+        placeholders. If the query returns rows, set select = True.
+        Data-modifying statements are not committed; call commit() or use
+        transaction(). """
+        if self.debug: logger.debug("%s", query)
+
+        cursor = self.cur.execute(query, params)
 
         if select:
             return cursor.fetchall()
-        else:
-            self.commit()
 
-    def select(self, query):
-        """ Return rows from an arbitrary SQL query """
-        return self.execute(query, select = True)
+    def select(self, query, params = (), readonly = False):
+        """ Return rows from an arbitrary SQL query. If readonly, run it on a
+        connection from the read-only pool. """
+        if not readonly:
+            return self.execute(query, params, select = True)
+
+        if self.debug: logger.debug("%s", query)
+        with self._cursor(readonly) as cursor:
+            return cursor.execute(query, params).fetchall()
+
+    def execute_iter(self, query, params = (), arraysize = 10000):
+        """ Execute a SQL query and yield the returned rows one at a time.
+        Rows are fetched arraysize at a time, so the full result set is never
+        held in memory. The query runs on its own cursor, so other statements
+        can be executed while iterating. """
+        for names, rows in self._fetch_chunks(query, params, arraysize):
+            yield from rows
 
     def update(self, filters, **kwargs):
         """ Update all rows returned by applying the filters based on a
-        dictionary of column names and values """
-        query = (self._get_update(**kwargs) + " " +
-                 self._get_where(filters, boolean = "AND"))
-        self.execute(query)
+        dictionary of column names and values. The update is not committed;
+        call commit() or use transaction(). """
+        query_update, params_update = self._get_update(**kwargs)
+        query_where, params_where = self._get_where(filters, boolean = "AND")
+        self.execute(query_update + " " + query_where,
+                     params_update + params_where)
 
     def _get_update(self, **kwargs):
-        """ Get UPDATE SET clause of query from dictionary of column names and
-        values """
+        """ Get UPDATE SET clause of query and its parameters from dictionary
+        of column names and values """
         kwargs = self.map_field_names(kwargs)
-        query = "UPDATE %s SET " % self.table
-        sets = ["[%s] = '%s'" % (col, self._sanitise(val))
-                for col, val in kwargs.items()]
-        query += ", ".join(sets)
-        return query
+        query = "UPDATE %s SET %s" % (
+            self.table, ", ".join(["[%s] = ?" % col for col in kwargs]))
+        return query, list(kwargs.values())
 
     def _get_where(self, filters, boolean = "AND"):
-        """ Get WHERE clause of query from dictionary of column name and value
-        pairs """
-        query = ""
-        if not filters is None and filters != {}:
-            filters_map = self.map_field_names(filters)
-            query = "WHERE "
-            for i, kv in enumerate(filters_map.items()):
-                k = kv[0]
-                vs = kv[1]
-                if isinstance(vs, str):
-                    vs = self._sanitise(vs)
-                    query += "[%s] = '%s' %s " % (k, vs, boolean)
-                elif isinstance(vs, list):
-                    for v in vs:
-                        v = self._sanitise(v)
-                        query += "[%s] = '%s' %s " % (k, v, boolean)
-                elif isinstance(vs, int) or isinstance(vs, float):
-                    query += "[%s] = %s %s " % (k, vs, boolean)
-                elif vs is None:
-                    query += "[%s] IS NULL %s " % (k, boolean)
-                else:
-                    raise ValueError("Unsupported value type in key %s" % k)
-            #remove final boolean keyword
-            query = query.strip()[:(-1*len(boolean))]
-        return query
+        """ Get WHERE clause of query and its parameters from dictionary of
+        column name and value pairs """
+        filter_keys, list_lens, params = self._get_filter_shape(filters)
+        return self._compile_where(filter_keys, list_lens, boolean), params
+
+    def _get_filter_shape(self, filters):
+        """ Split a dictionary of column name and value pairs into the shape
+        of the WHERE clause and the flat list of values to bind to it. The
+        shape is a tuple of mapped column names and a tuple of the number of
+        values each is compared against, or None to test for NULL. """
+        if filters is None or len(filters) == 0:
+            return (), (), []
+
+        list_lens = []
+        params = []
+        filter_keys = self._map_keys(tuple(filters))
+        for k, vs in zip(filter_keys, filters.values()):
+            if isinstance(vs, str):
+                list_lens.append(1)
+                params.append(vs)
+            elif isinstance(vs, list):
+                list_lens.append(len(vs))
+                params += vs
+            elif isinstance(vs, (int, float)):
+                list_lens.append(1)
+                params.append(vs)
+            elif vs is None:
+                list_lens.append(None)
+            else:
+                raise ValueError("Unsupported value type in key %s" % k)
+        return filter_keys, tuple(list_lens), params
+
+    @staticmethod
+    @functools.lru_cache(maxsize = 512)
+    def _compile_where(filter_keys, list_lens, boolean):
+        """ Return the WHERE clause with ? placeholders for a filter shape
+        from _get_filter_shape """
+        if len(filter_keys) == 0:
+            return ""
+
+        where_parts = []
+        for k, n in zip(filter_keys, list_lens):
+            if n is None:
+                where_parts.append("[%s] IS NULL" % k)
+            else:
+                where_parts += ["[%s] = ?" % k] * n
+        return "WHERE " + (" %s " % boolean).join(where_parts)
+
+    @staticmethod
+    @functools.lru_cache(maxsize = 512)
+    def _compile_filter(table, cols, filter_keys, list_lens, boolean,
+                        distinct, case_insensitive):
+        """ Return the SELECT query used by filter for a table, tuple of
+        column names and filter shape from _get_filter_shape """
+        query_parts = ["SELECT"]
+        if distinct:
+            query_parts.append("DISTINCT")
+        query_parts.append(TableCon._bracket_join(cols))
+        query_parts.append("FROM %s" % table)
+        if len(filter_keys) > 0:
+            query_parts.append(
+                TableCon._compile_where(filter_keys, list_lens, boolean))
+        if case_insensitive:
+            # COLLATE NOCASE doesn't work without a WHERE for some reason
+            if len(filter_keys) == 0: query_parts.append("WHERE TRUE")
+            query_parts.append("COLLATE NOCASE")
+
+        return " ".join(query_parts).replace("[*]", "*")
 
     def filter(self, filters, return_cols, rc = "columns", boolean = "AND",
-               distinct = True, case_insensitive = True):
+               distinct = True, case_insensitive = True, readonly = False):
         """
         Return the results of a generated SQL query
 
         filters is a dictionary of column names and values to filter with.
         return_cols is a list of column names to return
+
+        rc sets the shape of the results: "columns" returns a dictionary of
+        column names and lists of values, "rows" a list of rows as returned by
+        the cursor row_factory (sqlite3.Row unless overridden), and
+        "rowdict" a list of dictionaries of column names and values. "arrow"
+        returns a pyarrow Table and "numpy" a dictionary of column names and
+        numpy arrays; these require the respective optional package.
+
+        readonly = True runs the query on a connection from the read-only
+        pool, so it does not see uncommitted changes but can run in parallel
+        with queries from other threads.
         """
         if isinstance(return_cols, str):
             return_cols = [return_cols]
 
-        return_cols_map = self.map_field_names(return_cols)
-
-        query = "SELECT"
-        if distinct:
-            query += " DISTINCT "
-        query += "[" + "], [".join(return_cols_map) + "] "
-        query += "FROM %s " % self.table
-        query += self._get_where(filters, boolean)
-        if case_insensitive:
-            # COLLATE NOCASE doesn't work without a WHERE for some reason
-            if len(filters) == 0: query += "WHERE TRUE"
-            query += " COLLATE NOCASE "
-
-        query = query.replace("[*]", "*")
-        results = self.execute(query, select = True)
+        return_cols_map = self._map_keys(tuple(return_cols))
+
+        # the SQL is compiled once per query shape, so only the parameters
+        # are rebuilt on each call
+        filter_keys, list_lens, params = self._get_filter_shape(filters)
+        query = self._compile_filter(self.table, return_cols_map,
+                                     filter_keys, list_lens, boolean,
+                                     distinct, case_insensitive)
+        if rc == "arrow":
+            return self._fetch_arrow(query, params, return_cols_map,
+                                     readonly)
+        elif rc == "numpy":
+            return self._fetch_numpy(query, params, return_cols_map,
+                                     readonly)
+        elif rc == "rows":
+            return self.select(query, params, readonly)
+        elif rc not in ("columns", "rowdict"):
+            raise ValueError("Invalid shape specified. rc must be one"
+                             " of 'rows', 'columns', 'rowdict', 'arrow' or"
+                             " 'numpy'.")
 
-        # replace * with list of all columns in table
-        return_cols_flat = return_cols_map[:]
-        return_cols = []
-        for i, col in enumerate(return_cols_flat):
+        # read the results in chunks so only the output is held in memory in
+        # full
+        if rc == "columns":
+            columns = None
+            for names, rows in self._fetch_chunks(query, params,
+                                                  readonly = readonly):
+                if columns is None:
+                    keys = self._result_keys(return_cols_map, names)
+                    columns = [[] for key in keys]
+                for column, values in zip(columns, zip(*rows)):
+                    column.extend(values)
+            return dict(zip(keys, columns))
+        else:
+            results = []
+            keys = None
+            for names, rows in self._fetch_chunks(query, params,
+                                                  readonly = readonly):
+                if keys is None:
+                    keys = self._result_keys(return_cols_map, names)
+                results += [dict(zip(keys, row)) for row in rows]
+            return results
+
+    @staticmethod
+    def _result_keys(return_cols, names):
+        """ Return the keys for the columns of a filter result: the requested
+        column names, with each * replaced by the names of the columns it
+        expanded to in the cursor description names """
+        n_stars = return_cols.count("*")
+        if n_stars == 0:
+            return list(return_cols)
+
+        # every * expands to all columns of the same table
+        width = (len(names) - len(return_cols) + n_stars) // n_stars
+        keys = []
+        for col in return_cols:
             if col == "*":
-                return_cols += list(self.get_columns().keys())
+                keys += names[len(keys):len(keys) + width]
             else:
-                return_cols.append(col)
-
-        if rc == "columns":
-            # pivot each list in results to correspond to one column rather
-            # than one row
-            results_pivot = list(map(list, zip(*results)))
-
-            if results_pivot == []:
-                return {return_cols[i]: []
-                        for i in range(len(return_cols))}
+                keys.append(col)
+        return keys
+
+    @contextmanager
+    def _cursor(self, readonly = False):
+        """ Yield a new cursor on this connection, or on a connection from
+        the read-only pool if readonly. A separate cursor is not reset by
+        other statements run while its results are still being read. """
+        if not readonly:
+            yield from self._new_cursor(self.con)
+            return
+
+        with self.pool.acquire() as con:
+            yield from self._new_cursor(con)
+
+    def _new_cursor(self, con):
+        """ Yield a cursor on con with this table's row_factory, closing it
+        afterwards """
+        cursor = con.cursor()
+        cursor.row_factory = self._row_factory
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def _fetch_chunks(self, query, params = (), arraysize = 10000,
+                      readonly = False):
+        """ Execute a query and yield its results in lists of at most
+        arraysize rows, along with the list of column names. The first chunk
+        is always yielded, even if empty, so the column names are known. """
+        if self.debug: logger.debug("%s", query)
+
+        with self._cursor(readonly) as cursor:
+            cursor.execute(query, params)
+            cursor.arraysize = arraysize
+            names = [d[0] for d in cursor.description]
+            rows = cursor.fetchmany()
+            yield names, rows
+            while len(rows) > 0:
+                rows = cursor.fetchmany()
+                if len(rows) > 0:
+                    yield names, rows
+
+    def _fetch_arrow(self, query, params = (), return_cols = None,
+                     readonly = False):
+        """ Return the results of a query as a pyarrow Table, with columns
+        named by return_cols as in filter if given """
+        if pa is None:
+            raise ImportError("pyarrow is required for rc = 'arrow'")
+
+        chunks = None
+        for names, rows in self._fetch_chunks(query, params,
+                                              readonly = readonly):
+            if chunks is None:
+                chunks = [[] for name in names]
+            for chunk, values in zip(chunks, zip(*rows)):
+                chunk.append(pa.array(values))
+
+        if return_cols is not None:
+            names = self._result_keys(return_cols, names)
+        if len(chunks[0]) == 0:
+            return pa.table({name: [] for name in names})
+
+        columns = []
+        for chunk in chunks:
+            types = set(array.type for array in chunk
+                        if array.type != pa.null())
+            if len(types) <= 1:
+                # a batch of only NULLs is inferred as the null type, so cast
+                # it to the type of the rest of the column
+                if len(types) == 1:
+                    column_type = types.pop()
+                    chunk = [array.cast(column_type) for array in chunk]
+                columns.append(pa.chunked_array(chunk))
             else:
-                return {return_cols[i]: results_pivot[i]
-                        for i in range(len(return_cols))}
-        elif rc == "rows":
-            return [list(row) for row in results]
-        elif rc == "rowdict":
-            return [{return_cols[i]: row[i] for i in range(len(return_cols))}
-                     for row in results]
-        else:
-            raise ValueError("Invalid shape specified. rc must be one"
-                             " of 'rows', 'columns', or 'rowdict'.")
+                # batches inferred different types, so infer one type from
+                # all values in the column, promoting e.g. int64 to double
+                columns.append(pa.array(list(itertools.chain.from_iterable(
+                    array.to_pylist() for array in chunk))))
+        return pa.Table.from_arrays(columns, names = names)
+
+    def _fetch_numpy(self, query, params = (), return_cols = None,
+                     readonly = False):
+        """ Return the results of a query as a dictionary of column names and
+        numpy arrays, keyed by return_cols as in filter if given """
+        if np is None:
+            raise ImportError("numpy is required for rc = 'numpy'")
+
+        chunks = None
+        for names, rows in self._fetch_chunks(query, params,
+                                              readonly = readonly):
+            if chunks is None:
+                chunks = [[] for name in names]
+            for chunk, values in zip(chunks, zip(*rows)):
+                chunk.append(np.array(values))
+
+        if return_cols is not None:
+            names = self._result_keys(return_cols, names)
+        if len(chunks[0]) == 0:
+            return {name: np.array([]) for name in names}
+        return {name: np.concatenate(chunk)
+                for name, chunk in zip(names, chunks)}
+
+
+class TableConPool:
+    """ Pool of read-only connections to a database which can be shared
+    between threads, so that queries from several threads run in parallel
+    rather than being serialised on a single connection """
+    def __init__(self, db, size = 4):
+        """ The connections are opened on first use """
+        self.db = db
+        self.size = size
+        self.closed = False
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """ Open the connections in the pool """
+        if self.db == ":memory:":
+            raise ValueError("An in-memory database cannot be pooled")
+
+        uri = "%s?mode=ro" % Path(self.db).resolve().as_uri()
+        pool = queue.Queue()
+        for i in range(self.size):
+            pool.put(sql.connect(uri, uri = True, check_same_thread = False))
+
+        # the journal mode is left as the database has it, but readers only
+        # run alongside a writer in WAL mode
+        con = pool.get()
+        journal_mode = con.execute("PRAGMA journal_mode").fetchone()[0]
+        pool.put(con)
+        if journal_mode.lower() != "wal":
+            warnings.warn("Database %s uses journal_mode = %s, so pooled "
+                          "readers will block and be blocked by writers. "
+                          "Use journal_mode = WAL for concurrent reads."
+                          % (self.db, journal_mode))
+        self._pool = pool
+
+    @contextmanager
+    def acquire(self):
+        """ Borrow a connection from the pool, blocking until one is free,
+        and return it on exit """
+        with self._lock:
+            if self.closed:
+                raise ValueError("Connection pool is closed")
+            if self._pool is None:
+                self._open()
+
+        con = self._pool.get()
+        if con is None:
+            # the pool was closed while waiting; pass the marker on to any
+            # other waiting threads
+            self._pool.put(None)
+            raise ValueError("Connection pool is closed")
+        try:
+            yield con
+        finally:
+            self._pool.put(con)
 
+    def close(self):
+        """ Close all connections in the pool, waiting for any borrowed
+        connections to be returned. Closing an already closed pool does
+        nothing. """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self._pool is not None:
+            for i in range(self.size):
+                self._pool.get().close()
+            self._pool.put(None)
 
 class MultiConnection:
     """ Light class to handle connecting to multiple tables simultaneously
     within the same database """
-    def __init__(self, db, tables = None, debug = False):
+    def __init__(self, db, tables = None, debug = False, **kwargs):
+        """
+        kwargs are passed on to TableCon, so the connection, PRAGMA and pool
+        options are the same as for a single table. All tables share one
+        connection and one read-only pool.
+        """
         self.db = db
         if tables is None:
             raise AttributeError("At least one table must be specified")
@@ -311,8 +792,15 @@ class MultiConnection:
         self._tables = tables
         self.connections = {}
 
+        # share one connection, and so one page cache, and one pool between
+        # all tables. Both are owned by a TableCon without a table, so they
+        # are opened with the same defaults and options as any other
+        self._owner = TableCon(db = db, debug = debug, **kwargs)
+        self.con = self._owner.con
+        self.pool = self._owner.pool
         for table in tables:
-            tcon = TableCon(db = db, table = table, debug = debug)
+            tcon = TableCon(db = db, table = table, debug = debug,
+                            con = self.con, pool = self.pool, **kwargs)
             self.__dict__[table] = tcon
             self.connections[table] = tcon
 
@@ -326,6 +814,11 @@ class MultiConnection:
     def close(self):
         for connection in self.connections.values():
             connection.close()
+        # commits any outstanding transaction and closes the shared
+        # connection and pool
+        self._owner.close()
+        self.con = None
+        self.pool = None
 
 
 # if __name__ == "__main__":